@@ -1,7 +1,13 @@
+import contextlib
+import functools
 import gc
+import io
 import json
 import logging
 import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 
 import numpy as np
@@ -9,12 +15,18 @@ import timm
 import torch
 from PIL import Image
 from torch import nn
+from torchvision.io import ImageReadMode, decode_image
+from torchvision.transforms import InterpolationMode, v2
+
+from .trt import load_or_build_engine
 
 
 CUDA_ERROR_MARKERS = ("cuda", "cublas", "cudnn", "out of memory")
 MODEL_NAME = "resnet152"
 IMAGE_SIZE = 224
 HIDDEN_DIM = 512
+WARMUP_BATCH_SIZES = (1, 4, 16, 64)
+IMAGE_EXTENSIONS = {".bmp", ".gif", ".jpeg", ".jpg", ".png", ".webp"}
 
 
 def _get_env_int(name: str, default: int, minimum: int | None = None) -> int:
@@ -36,14 +48,87 @@ def _get_env_bool(name: str, default: bool) -> bool:
     return raw.strip().lower() not in {"0", "false", "no", "off"}
 
 
+def _default_num_threads() -> int:
+    # Forked worker processes share the host's cores, so split them evenly.
+    workers = _get_env_int("WORKER_PROCESSES", 1, minimum=1)
+    return max(1, (os.process_cpu_count() or 1) // workers)
+
+
+_decode_pool = ThreadPoolExecutor(
+    max_workers=_get_env_int("DECODE_WORKERS", _default_num_threads(), minimum=1),
+    thread_name_prefix="autotagger-decode",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_vocab(tags_path: Path):
+    with tags_path.open("r", encoding="utf-8") as tags_file:
+        vocab = tuple(json.load(tags_file))
+    vocab_arr = np.asarray(vocab)
+    vocab_arr.flags.writeable = False
+    return vocab, vocab_arr
+
+
+def _load_checkpoint(model_path: Path):
+    if zipfile.is_zipfile(model_path):
+        return _load_mapped_checkpoint(model_path)
+    # Legacy (non-zipfile) checkpoints cannot be memory-mapped. Load them uncached so
+    # the heap copy is freed once the weights have been assigned to the model.
+    return _normalize_checkpoint(torch.load(model_path, map_location="cpu", weights_only=True), model_path)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_mapped_checkpoint(model_path: Path):
+    # Memory-mapping keeps the checkpoint file-backed, so loading it never needs a second
+    # heap copy and separate worker processes share the page cache.
+    checkpoint = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+    return _normalize_checkpoint(checkpoint, model_path)
+
+
+def _normalize_checkpoint(checkpoint, model_path: Path):
+    if isinstance(checkpoint, dict):
+        for key in ("model", "state_dict"):
+            if key in checkpoint and isinstance(checkpoint[key], dict):
+                checkpoint = checkpoint[key]
+                break
+    if not isinstance(checkpoint, dict):
+        raise TypeError(f"Unsupported checkpoint format in {model_path}")
+
+    state_dict = {}
+    for key, value in checkpoint.items():
+        normalized = key
+        if normalized.startswith("module."):
+            normalized = normalized[len("module."):]
+        state_dict[normalized] = value
+    return state_dict
+
+
 def _process_scores(scores, vocab, threshold, limit):
-    pairs = [
-        (tag, float(score))
-        for tag, score in zip(vocab, scores)
-        if float(score) >= threshold
+    limit = min(limit, scores.shape[1])
+    if limit <= 0:
+        return [{} for _ in range(scores.shape[0])]
+    if limit < scores.shape[1]:
+        indices = np.argpartition(scores, -limit, axis=1)[:, -limit:]
+    else:
+        indices = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    values = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-values, axis=1, kind="stable")
+    indices = np.take_along_axis(indices, order, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    return _process_top_scores(values, indices, vocab, threshold)
+
+
+def _process_top_scores(values, indices, vocab, threshold):
+    # Rows are sorted by descending score, so the tags passing the threshold form a prefix.
+    # Compare in float64 like a Python float would; float16 scores from autocast would
+    # otherwise round the threshold down and let tags just below it through.
+    counts = (values.astype(np.float64) >= threshold).sum(axis=1).tolist()
+    tag_rows = vocab[indices].tolist()
+    value_rows = values.tolist()
+    return [
+        dict(zip(tag_row[:count], value_row[:count]))
+        for tag_row, value_row, count in zip(tag_rows, value_rows, counts)
     ]
-    pairs.sort(key=lambda pair: pair[1], reverse=True)
-    return dict(pairs[:limit])
 
 
 class AdaptiveConcatPool2d(nn.Module):
@@ -84,6 +169,20 @@ class AutotaggerModel(nn.Sequential):
         super().__init__(backbone, head)
 
 
+class InferenceLane:
+    def __init__(self, device, batch_size: int):
+        self.lock = threading.Lock()
+        self.stream = None
+        self.copy_stream = None
+        self.copy_done = None
+        self.pin_memory = device.type == "cuda"
+        if device.type == "cuda":
+            self.stream = torch.cuda.Stream(device)
+            self.copy_stream = torch.cuda.Stream(device)
+        # Host-side batch buffer reused across requests; pinned when it feeds CUDA uploads.
+        self.staging = torch.empty(batch_size, 3, IMAGE_SIZE, IMAGE_SIZE, pin_memory=self.pin_memory)
+
+
 class Autotagger:
     def __init__(self, model_path="models/model.pth", tags_path="data/tags.json"):
         self.model_path = Path(model_path)
@@ -91,17 +190,51 @@ class Autotagger:
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.use_amp = self.device.type == "cuda"
         self.cudnn_benchmark = _get_env_bool("CUDNN_BENCHMARK", True)
+        self.channels_last = self.device.type == "cuda" and _get_env_bool("CHANNELS_LAST", True)
+        self.cuda_graphs = self.device.type == "cuda" and _get_env_bool("CUDA_GRAPHS", False)
+        self.use_trt = self.device.type == "cuda" and _get_env_bool("USE_TRT", False)
+        self.trt_cache_dir = Path(os.getenv("TRT_CACHE_DIR", "models"))
+        self.cpu_quantize = self.device.type == "cpu" and _get_env_bool("CPU_QUANTIZE", False)
+        calibration_dir = os.getenv("QUANTIZE_CALIBRATION_DIR", "").strip()
+        if self.cpu_quantize and not calibration_dir:
+            # Activation ranges come from these images, so they must be representative
+            # of real inputs; never fall back to whatever happens to be on disk.
+            raise ValueError("CPU_QUANTIZE requires QUANTIZE_CALIBRATION_DIR to be set")
+        self.calibration_dir = Path(calibration_dir) if calibration_dir else None
+        self.calibration_images = _get_env_int("QUANTIZE_CALIBRATION_IMAGES", 32, minimum=1)
         self.batch_size = _get_env_int("BATCH_SIZE", 32, minimum=1)
         self.min_batch_size = _get_env_int("MIN_BATCH_SIZE", 1, minimum=1)
         self.gc_every = _get_env_int("GC_EVERY", 0, minimum=0)
         self.empty_cache_min_images = _get_env_int("EMPTY_CACHE_MIN_IMAGES", 0, minimum=0)
+        self.stream_count = _get_env_int("INFERENCE_STREAMS", 1, minimum=1)
+        self.warmup = _get_env_bool("WARMUP", self.device.type == "cuda")
+        self.num_threads = _get_env_int("TORCH_NUM_THREADS", _default_num_threads(), minimum=1)
+        if self.device.type == "cpu":
+            torch.set_num_threads(self.num_threads)
         self.request_count = 0
-        self.vocab = self._load_vocab(self.tags_path)
+        self.resize = v2.Resize((IMAGE_SIZE, IMAGE_SIZE), interpolation=InterpolationMode.BILINEAR, antialias=True)
+        self.trt_engine = None
+        self.graph = None
+        self.static_in = None
+        self.static_out = None
+        self.graph_lock = threading.Lock()
+        self.graph_done = None
+        self.lanes = [InferenceLane(self.device, self.batch_size) for _ in range(self.stream_count)]
+        self._lane_slots = threading.Semaphore(len(self.lanes))
+        self.vocab, self._vocab_arr = _load_vocab(self.tags_path.resolve())
         self.model = self.init_model(self.model_path, len(self.vocab))
+        if self.warmup:
+            self._warmup()
         logging.info(
-            "Autotagger device=%s amp=%s batch_size=%d min_batch_size=%d cudnn_benchmark=%s gc_every=%d empty_cache_min_images=%d model=%s arch=%s num_classes=%d",
+            "Autotagger device=%s threads=%d amp=%s int8=%s channels_last=%s cuda_graphs=%s tensorrt=%s streams=%d batch_size=%d min_batch_size=%d cudnn_benchmark=%s gc_every=%d empty_cache_min_images=%d model=%s arch=%s num_classes=%d",
             self.device.type,
+            torch.get_num_threads(),
             self.use_amp,
+            self.cpu_quantize,
+            self.channels_last,
+            self.cuda_graphs,
+            self.use_trt,
+            self.stream_count,
             self.batch_size,
             self.min_batch_size,
             self.cudnn_benchmark,
@@ -112,32 +245,15 @@ class Autotagger:
             len(self.vocab),
         )
 
-    def _load_vocab(self, tags_path: Path):
-        with tags_path.open("r", encoding="utf-8") as tags_file:
-            return json.load(tags_file)
-
-    def _load_checkpoint(self, model_path: Path):
-        checkpoint = torch.load(model_path, map_location="cpu")
-        if isinstance(checkpoint, dict):
-            for key in ("model", "state_dict"):
-                if key in checkpoint and isinstance(checkpoint[key], dict):
-                    checkpoint = checkpoint[key]
-                    break
-        if not isinstance(checkpoint, dict):
-            raise TypeError(f"Unsupported checkpoint format in {model_path}")
-
-        state_dict = {}
-        for key, value in checkpoint.items():
-            normalized = key
-            if normalized.startswith("module."):
-                normalized = normalized[len("module."):]
-            state_dict[normalized] = value
-        return state_dict
-
     def init_model(self, model_path: Path, num_classes: int):
         model = AutotaggerModel(MODEL_NAME, num_classes)
-        state_dict = self._load_checkpoint(model_path)
-        missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+        state_dict = _load_checkpoint(model_path.resolve())
+        # Assigning skips a host copy when the weights move to the GPU right after. On CPU
+        # they are copied so live parameters never alias the mmap'd file, which would
+        # fault or change under a running worker if model.pth were overwritten in place.
+        missing_keys, unexpected_keys = model.load_state_dict(
+            state_dict, strict=False, assign=self.device.type == "cuda"
+        )
         if missing_keys or unexpected_keys:
             raise RuntimeError(
                 f"checkpoint incompatibility for {model_path}: missing={missing_keys} unexpected={unexpected_keys}"
@@ -147,44 +263,185 @@ class Autotagger:
         model.to(self.device)
         if self.device.type == "cuda":
             torch.backends.cudnn.benchmark = self.cudnn_benchmark
+        if self.channels_last:
+            model.to(memory_format=torch.channels_last)
+        if self.use_trt:
+            self.trt_engine = load_or_build_engine(
+                model, model_path, self.trt_cache_dir, IMAGE_SIZE, num_classes, self.device
+            )
+        elif self.cuda_graphs:
+            model = self._capture_cuda_graph(model)
+        if self.cpu_quantize:
+            model = self._quantize_int8(model)
         return model
 
-    def _prepare_image(self, item):
+    def _quantize_int8(self, model):
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        paths = sorted(
+            path for path in self.calibration_dir.rglob("*") if path.suffix.lower() in IMAGE_EXTENSIONS
+        )[: self.calibration_images]
+        if not paths:
+            logging.warning(
+                "CPU_QUANTIZE is enabled but no calibration images were found in %s; keeping FP32 model",
+                self.calibration_dir,
+            )
+            return model
+
+        backend = "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+        torch.backends.quantized.engine = backend
+        example_inputs = (torch.zeros(1, 3, IMAGE_SIZE, IMAGE_SIZE),)
+        prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs=example_inputs)
+        with torch.no_grad():
+            for start in range(0, len(paths), self.batch_size):
+                images = list(_decode_pool.map(self._prepare_image, paths[start : start + self.batch_size]))
+                prepared(self._prepare_batch(images, self.lanes[0]))
+        logging.info("Quantized model to INT8 (%s) using %d calibration images", backend, len(paths))
+        return convert_fx(prepared)
+
+    def _capture_cuda_graph(self, model):
+        memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+        model.half()
+        static_in = torch.zeros(
+            self.batch_size, 3, IMAGE_SIZE, IMAGE_SIZE, device=self.device, dtype=torch.float16
+        ).to(memory_format=memory_format)
+
+        with torch.no_grad():
+            scripted = torch.jit.freeze(torch.jit.trace(model, static_in))
+
+            # Capture requires the allocator and cuDNN to have settled, so run a few
+            # iterations on a side stream first.
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                for _ in range(3):
+                    scripted(static_in)
+            torch.cuda.current_stream().wait_stream(side_stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_out = scripted(static_in)
+
+        self.graph = graph
+        self.static_in = static_in
+        self.static_out = static_out
+        return scripted
+
+    def _decode_image(self, item):
         if isinstance(item, (str, Path)):
-            with Image.open(item) as image:
-                image = image.convert("RGB")
-                image = image.resize((IMAGE_SIZE, IMAGE_SIZE), resample=Image.BILINEAR)
-                array = np.asarray(image, dtype=np.float32) / 255.0
+            try:
+                image = decode_image(str(item), mode=ImageReadMode.RGB)
+            except (RuntimeError, ValueError):
+                # torchvision only decodes JPEG/PNG/GIF/WebP; let Pillow handle the rest.
+                with Image.open(item) as pil_image:
+                    image = v2.functional.pil_to_tensor(pil_image.convert("RGB"))
+        elif isinstance(item, (bytes, bytearray, memoryview)):
+            try:
+                image = decode_image(torch.frombuffer(item, dtype=torch.uint8), mode=ImageReadMode.RGB)
+            except (RuntimeError, ValueError):
+                with Image.open(io.BytesIO(item)) as pil_image:
+                    image = v2.functional.pil_to_tensor(pil_image.convert("RGB"))
         elif isinstance(item, Image.Image):
-            image = item.convert("RGB")
-            image = image.resize((IMAGE_SIZE, IMAGE_SIZE), resample=Image.BILINEAR)
-            array = np.asarray(image, dtype=np.float32) / 255.0
+            image = v2.functional.pil_to_tensor(item.convert("RGB"))
         else:
             raise TypeError(f"Unsupported image input type: {type(item).__name__}")
 
-        if array.ndim != 3 or array.shape[2] != 3:
+        if image.ndim == 4:
+            image = image[0]
+        if image.dtype != torch.uint8:
+            # 16-bit PNGs decode to uint16; bring them to the 8-bit range the batch scaling expects.
+            image = v2.functional.to_dtype(image, torch.uint8, scale=True)
+        if image.ndim != 3 or image.shape[0] != 3:
             raise ValueError("expected RGB image input")
-        return torch.from_numpy(np.transpose(array, (2, 0, 1)))
+        return image
 
-    def _prepare_batch(self, items):
-        tensors = [self._prepare_image(item) for item in items]
-        batch = torch.stack(tensors, dim=0)
+    def _prepare_image(self, item):
+        return self.resize(self._decode_image(item))
+
+    def _fill_batch(self, out, images):
+        for row, image in zip(out, images):
+            row.copy_(image)
+        return out.mul_(1.0 / 255.0)
+
+    def _lane_stream(self, lane):
+        if lane.stream is None:
+            return contextlib.nullcontext()
+        return torch.cuda.stream(lane.stream)
+
+    def _warmup(self):
+        # cuDNN benchmarking picks kernels per input shape on first use; pay that here
+        # instead of on the first requests.
+        sizes = sorted({min(size, self.batch_size) for size in WARMUP_BATCH_SIZES} | {self.batch_size})
+        memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+        with self._lane_stream(self.lanes[0]):
+            for size in sizes:
+                batch = torch.zeros(size, 3, IMAGE_SIZE, IMAGE_SIZE, device=self.device)
+                self._run_inference(batch.contiguous(memory_format=memory_format))
         if self.device.type == "cuda":
-            batch = batch.pin_memory()
-            batch = batch.to(self.device, non_blocking=True)
-        else:
-            batch = batch.to(self.device)
+            torch.cuda.synchronize(self.device)
+        logging.info("Warmed up batch sizes %s", sizes)
+
+    def _staging_buffer(self, lane, count):
+        # The previous upload must finish before its pinned source is overwritten.
+        if lane.copy_done is not None:
+            lane.copy_done.synchronize()
+        if count > lane.staging.shape[0]:
+            lane.staging = torch.empty(count, 3, IMAGE_SIZE, IMAGE_SIZE, pin_memory=lane.pin_memory)
+        return lane.staging[:count]
+
+    def _prepare_batch(self, images, lane):
+        staging = self._fill_batch(self._staging_buffer(lane, len(images)), images)
+        if self.device.type != "cuda":
+            return staging
+
+        memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+        with torch.cuda.stream(lane.copy_stream):
+            batch = staging.to(self.device, non_blocking=True, memory_format=memory_format)
+            lane.copy_done = lane.copy_stream.record_event()
+        compute_stream = torch.cuda.current_stream()
+        compute_stream.wait_event(lane.copy_done)
+        batch.record_stream(compute_stream)
         return batch
 
+    def _replay_cuda_graph(self, batch):
+        # Rows past `count` keep stale inputs from earlier batches; their outputs are discarded.
+        # The static buffers are shared by every lane, so each replay is ordered after the last.
+        count = batch.shape[0]
+        with self.graph_lock:
+            stream = torch.cuda.current_stream()
+            if self.graph_done is not None:
+                stream.wait_event(self.graph_done)
+            self.static_in[:count].copy_(batch, non_blocking=True)
+            self.graph.replay()
+            scores = torch.sigmoid(self.static_out[:count].float())
+            self.graph_done = stream.record_event()
+        return scores
+
     def _run_inference(self, batch):
         with torch.inference_mode():
-            if self.use_amp:
+            if self.trt_engine is not None and batch.shape[0] <= self.trt_engine.max_batch_size:
+                logits = self.trt_engine(batch)
+            elif self.graph is not None:
+                if batch.shape[0] <= self.static_in.shape[0]:
+                    return self._replay_cuda_graph(batch)
+                # Oversized batches run the frozen FP16 module eagerly.
+                logits = self.model(batch.half()).float()
+            elif self.use_amp:
                 with torch.autocast(device_type="cuda", dtype=torch.float16):
                     logits = self.model(batch)
             else:
                 logits = self.model(batch)
         return torch.sigmoid(logits)
 
+    def _postprocess(self, scores, threshold, limit):
+        if self.device.type == "cuda":
+            # Only the top `limit` columns per row are copied back to the host.
+            values, indices = scores.topk(min(limit, scores.shape[1]), dim=1)
+            return _process_top_scores(values.cpu().numpy(), indices.cpu().numpy(), self._vocab_arr, threshold)
+
+        return _process_scores(scores.numpy(), self._vocab_arr, threshold=threshold, limit=limit)
+
     def _cuda_runtime_error(self, err):
         msg = str(err).lower()
         return self.device.type == "cuda" and any(marker in msg for marker in CUDA_ERROR_MARKERS)
@@ -213,29 +470,58 @@ class Autotagger:
             return next_bs
         raise err
 
+    def _acquire_lane(self):
+        if len(self.lanes) == 1:
+            lane = self.lanes[0]
+            lane.lock.acquire()
+            return lane
+
+        # Holding a slot guarantees at least one lane lock is free.
+        self._lane_slots.acquire()
+        for lane in self.lanes:
+            if lane.lock.acquire(blocking=False):
+                return lane
+        self._lane_slots.release()
+        raise RuntimeError("no free inference lane")
+
+    def _release_lane(self, lane):
+        lane.lock.release()
+        if len(self.lanes) > 1:
+            self._lane_slots.release()
+
     def predict(self, files, threshold=0.01, limit=50, bs=None):
         if not files:
             return []
 
+        lane = self._acquire_lane()
+        try:
+            with self._lane_stream(lane):
+                return self._predict(files, threshold, limit, bs, lane)
+        finally:
+            self._release_lane(lane)
+
+    def _predict(self, files, threshold, limit, bs, lane):
         if bs is None:
             bs = self.batch_size
 
         outputs = []
         batch = None
         scores = None
+        # Decoding runs ahead on the thread pool while earlier batches are on the device.
+        pending = [_decode_pool.submit(self._prepare_image, item) for item in files]
+        decoded = []
         try:
             start = 0
             while start < len(files):
                 current_bs = min(bs, len(files) - start)
                 while True:
                     try:
-                        batch_items = files[start : start + current_bs]
-                        batch = self._prepare_batch(batch_items)
-                        scores = self._run_inference(batch).detach().cpu().numpy()
-                        outputs.extend(
-                            _process_scores(score_row, self.vocab, threshold=threshold, limit=limit)
-                            for score_row in scores
-                        )
+                        while len(decoded) < current_bs:
+                            decoded.append(pending[start + len(decoded)].result())
+                        batch = self._prepare_batch(decoded[:current_bs], lane)
+                        scores = self._run_inference(batch)
+                        outputs.extend(self._postprocess(scores, threshold, limit))
+                        del decoded[:current_bs]
                         start += current_bs
                         break
                     except RuntimeError as err:
@@ -256,6 +542,11 @@ class Autotagger:
                     scores = None
             return outputs
         finally:
+            # Inputs may be views into shared memory the caller unmaps once we return,
+            # so no decode may still be reading them.
+            for future in pending:
+                future.cancel()
+            wait(pending)
             if batch is not None:
                 del batch
             if scores is not None:
@@ -0,0 +1,148 @@
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import torch
+
+
+TRT_BATCH_BUCKETS = (1, 4, 16, 64)
+TRT_OPT_BATCH = 16
+INPUT_NAME = "x"
+OUTPUT_NAME = "y"
+
+
+def _import_tensorrt():
+    try:
+        import tensorrt
+    except ImportError as err:
+        raise RuntimeError("USE_TRT=1 requires the tensorrt package to be installed") from err
+    return tensorrt
+
+
+def export_onnx(model, onnx_path: Path, image_size: int):
+    device = next(model.parameters()).device
+    dummy = torch.zeros(1, 3, image_size, image_size, device=device)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            dummy,
+            str(onnx_path),
+            input_names=[INPUT_NAME],
+            output_names=[OUTPUT_NAME],
+            opset_version=17,
+            dynamic_axes={INPUT_NAME: {0: "b"}, OUTPUT_NAME: {0: "b"}},
+            dynamo=False,
+        )
+
+
+def build_engine(onnx_path: Path, engine_path: Path, image_size: int, buckets=TRT_BATCH_BUCKETS):
+    trt = _import_tensorrt()
+    trt_logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(trt_logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, trt_logger)
+    if not parser.parse_from_file(str(onnx_path)):
+        errors = "; ".join(str(parser.get_error(i)) for i in range(parser.num_errors))
+        raise RuntimeError(f"failed to parse {onnx_path}: {errors}")
+
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.FP16)
+    profile = builder.create_optimization_profile()
+    opt_batch = min(max(TRT_OPT_BATCH, min(buckets)), max(buckets))
+    profile.set_shape(
+        INPUT_NAME,
+        (min(buckets), 3, image_size, image_size),
+        (opt_batch, 3, image_size, image_size),
+        (max(buckets), 3, image_size, image_size),
+    )
+    config.add_optimization_profile(profile)
+
+    serialized = builder.build_serialized_network(network, config)
+    if serialized is None:
+        raise RuntimeError(f"failed to build TensorRT engine from {onnx_path}")
+    # Write beside the target and rename so concurrent workers never load a partial plan.
+    fd, tmp_name = tempfile.mkstemp(dir=engine_path.parent, prefix=f".{engine_path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(serialized)
+        os.replace(tmp_name, engine_path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+def engine_cache_path(cache_dir: Path, model_path: Path, device) -> Path:
+    # Plans only load on the TensorRT version and GPU architecture that built them.
+    trt = _import_tensorrt()
+    major, minor = torch.cuda.get_device_capability(device)
+    return cache_dir / f"{model_path.stem}-fp16-trt{trt.__version__}-sm{major}{minor}.plan"
+
+
+def _build_from_model(model, engine_path: Path, image_size: int):
+    with tempfile.TemporaryDirectory(dir=engine_path.parent) as tmp_dir:
+        onnx_path = Path(tmp_dir) / "model.onnx"
+        export_onnx(model, onnx_path, image_size)
+        build_engine(onnx_path, engine_path, image_size)
+
+
+def load_or_build_engine(model, model_path: Path, cache_dir: Path, image_size: int, num_classes: int, device):
+    trt = _import_tensorrt()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    engine_path = engine_cache_path(cache_dir, model_path, device)
+    if not engine_path.exists() or engine_path.stat().st_mtime < model_path.stat().st_mtime:
+        logging.info("Building TensorRT engine %s from %s", engine_path, model_path)
+        _build_from_model(model, engine_path, image_size)
+
+    runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+    engine = runtime.deserialize_cuda_engine(engine_path.read_bytes())
+    if engine is None:
+        logging.warning("Cached TensorRT engine %s could not be loaded, rebuilding", engine_path)
+        _build_from_model(model, engine_path, image_size)
+        engine = runtime.deserialize_cuda_engine(engine_path.read_bytes())
+        if engine is None:
+            raise RuntimeError(f"failed to load TensorRT engine {engine_path}")
+    return TensorRTEngine(runtime, engine, image_size, num_classes, device)
+
+
+class TensorRTEngine:
+    def __init__(self, runtime, engine, image_size: int, num_classes: int, device, buckets=TRT_BATCH_BUCKETS):
+        # The runtime must outlive every engine it deserialized.
+        self.runtime = runtime
+        self.engine = engine
+        self.context = self.engine.create_execution_context()
+        self.lock = threading.Lock()
+        self.done = None
+        self.buckets = tuple(sorted(buckets))
+        self.max_batch_size = self.buckets[-1]
+        self.inputs = {
+            bucket: torch.zeros(bucket, 3, image_size, image_size, device=device, dtype=torch.float32)
+            for bucket in self.buckets
+        }
+        self.outputs = {
+            bucket: torch.empty(bucket, num_classes, device=device, dtype=torch.float32)
+            for bucket in self.buckets
+        }
+
+    def _bucket_for(self, count: int) -> int:
+        return next(bucket for bucket in self.buckets if bucket >= count)
+
+    def __call__(self, batch):
+        count = batch.shape[0]
+        bucket = self._bucket_for(count)
+        inputs = self.inputs[bucket]
+        outputs = self.outputs[bucket]
+        with self.lock:
+            stream = torch.cuda.current_stream()
+            if self.done is not None:
+                stream.wait_event(self.done)
+            inputs[:count].copy_(batch)
+            self.context.set_input_shape(INPUT_NAME, tuple(inputs.shape))
+            self.context.set_tensor_address(INPUT_NAME, inputs.data_ptr())
+            self.context.set_tensor_address(OUTPUT_NAME, outputs.data_ptr())
+            if not self.context.execute_async_v3(stream.cuda_stream):
+                raise RuntimeError("TensorRT execution failed")
+            result = outputs[:count].clone()
+            self.done = stream.record_event()
+        return result
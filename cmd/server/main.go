@@ -31,11 +31,18 @@ type prediction struct {
 	Tags     map[string]float64 `json:"tags"`
 }
 
+type shmSegment struct {
+	Name     string `json:"name"`
+	Size     int64  `json:"size"`
+	Filename string `json:"filename"`
+}
+
 type workerRequest struct {
-	ID        uint64   `json:"id"`
-	Files     []string `json:"files"`
-	Threshold float64  `json:"threshold"`
-	Limit     int      `json:"limit"`
+	ID        uint64       `json:"id"`
+	Files     []string     `json:"files,omitempty"`
+	Shm       []shmSegment `json:"shm,omitempty"`
+	Threshold float64      `json:"threshold"`
+	Limit     int          `json:"limit"`
 }
 
 type workerResponse struct {
@@ -55,9 +62,9 @@ type workerClient struct {
 	closed    atomic.Bool
 }
 
-func newWorkerClient(ctx context.Context, pythonBin, scriptPath string) (*workerClient, error) {
+func newWorkerClient(ctx context.Context, pythonBin, scriptPath string, env []string) (*workerClient, error) {
 	cmd := exec.CommandContext(ctx, pythonBin, scriptPath)
-	cmd.Env = os.Environ()
+	cmd.Env = env
 
 	stdin, err := cmd.StdinPipe()
 	if err != nil {
@@ -146,7 +153,7 @@ func (wc *workerClient) failAll(msg string) {
 	}
 }
 
-func (wc *workerClient) predict(ctx context.Context, files []string, threshold float64, limit int) ([]prediction, error) {
+func (wc *workerClient) predict(ctx context.Context, req workerRequest) ([]prediction, error) {
 	if wc.closed.Load() {
 		return nil, errors.New("worker is not running")
 	}
@@ -157,7 +164,7 @@ func (wc *workerClient) predict(ctx context.Context, files []string, threshold f
 	wc.pending[id] = respCh
 	wc.pendingMu.Unlock()
 
-	req := workerRequest{ID: id, Files: files, Threshold: threshold, Limit: limit}
+	req.ID = id
 	data, err := json.Marshal(req)
 	if err != nil {
 		return nil, fmt.Errorf("marshal request: %w", err)
@@ -201,6 +208,7 @@ type workerPool struct {
 	ctx       context.Context
 	pythonBin string
 	script    string
+	env       []string
 	workers   []*workerClient
 	rr        atomic.Uint64
 	mu        sync.RWMutex
@@ -214,10 +222,11 @@ func newWorkerPool(ctx context.Context, pythonBin, scriptPath string, count int)
 		ctx:       ctx,
 		pythonBin: pythonBin,
 		script:    scriptPath,
+		env:       workerEnv(os.Environ(), count),
 		workers:   make([]*workerClient, 0, count),
 	}
 	for i := 0; i < count; i++ {
-		worker, err := newWorkerClient(ctx, pythonBin, scriptPath)
+		worker, err := newWorkerClient(ctx, pythonBin, scriptPath, pool.env)
 		if err != nil {
 			pool.close()
 			return nil, fmt.Errorf("start worker %d/%d: %w", i+1, count, err)
@@ -227,6 +236,16 @@ func newWorkerPool(ctx context.Context, pythonBin, scriptPath string, count int)
 	return pool, nil
 }
 
+func workerEnv(base []string, count int) []string {
+	env := make([]string, 0, len(base)+1)
+	for _, kv := range base {
+		if !strings.HasPrefix(kv, "WORKER_PROCESSES=") {
+			env = append(env, kv)
+		}
+	}
+	return append(env, "WORKER_PROCESSES="+strconv.Itoa(count))
+}
+
 func (wp *workerPool) anyAlive() bool {
 	wp.mu.RLock()
 	defer wp.mu.RUnlock()
@@ -238,7 +257,7 @@ func (wp *workerPool) anyAlive() bool {
 	return false
 }
 
-func (wp *workerPool) predict(ctx context.Context, files []string, threshold float64, limit int) ([]prediction, error) {
+func (wp *workerPool) predict(ctx context.Context, req workerRequest) ([]prediction, error) {
 	wp.mu.RLock()
 	n := len(wp.workers)
 	wp.mu.RUnlock()
@@ -259,7 +278,7 @@ func (wp *workerPool) predict(ctx context.Context, files []string, threshold flo
 			}
 			continue
 		}
-		predictions, err := w.predict(ctx, files, threshold, limit)
+		predictions, err := w.predict(ctx, req)
 		if err == nil {
 			return predictions, nil
 		}
@@ -296,7 +315,7 @@ func (wp *workerPool) respawn(idx int) error {
 		return nil
 	}
 
-	newWorker, err := newWorkerClient(wp.ctx, wp.pythonBin, wp.script)
+	newWorker, err := newWorkerClient(wp.ctx, wp.pythonBin, wp.script, wp.env)
 	if err != nil {
 		return err
 	}
@@ -341,9 +360,15 @@ type tagPair struct {
 }
 
 type htmlResult struct {
-	ImageData string
-	Tags      []tagPair
-	TagText   string
+	image   []byte
+	Tags    []tagPair
+	TagText string
+}
+
+// ImageData is called by the template while it streams the response, so only
+// one upload's base64 encoding is held in memory at a time.
+func (hr htmlResult) ImageData() string {
+	return base64.StdEncoding.EncodeToString(hr.image)
 }
 
 type server struct {
@@ -353,6 +378,7 @@ type server struct {
 	maxFileBytes   int64
 	maxFiles       int
 	maxLimit       int
+	useShm         bool
 	evaluateOK     atomic.Bool
 	indexTmpl      *template.Template
 	evalTmpl       *template.Template
@@ -531,16 +557,9 @@ func (s *server) handleEvaluate(w http.ResponseWriter, r *http.Request) {
 		return
 	}
 
-	tmpDir, err := os.MkdirTemp("", "autotagger-upload-*")
-	if err != nil {
-		s.writeError(w, format, http.StatusInternalServerError, "InternalError", "failed to create temp dir")
-		return
-	}
-	defer os.RemoveAll(tmpDir)
-
-	paths := make([]string, 0, len(files))
 	origNames := make([]string, 0, len(files))
-	for i, fh := range files {
+	uploads := make([][]byte, 0, len(files))
+	for _, fh := range files {
 		if err := validateUploadedFile(fh, s.maxFileBytes); err != nil {
 			s.writeError(w, format, http.StatusBadRequest, "BadRequest", err.Error())
 			return
@@ -551,31 +570,58 @@ func (s *server) handleEvaluate(w http.ResponseWriter, r *http.Request) {
 			s.writeError(w, format, http.StatusBadRequest, "BadRequest", "failed to open upload")
 			return
 		}
+		data := make([]byte, fh.Size)
+		_, readErr := io.ReadFull(f, data)
+		_ = f.Close()
+		if readErr != nil {
+			s.writeError(w, format, http.StatusInternalServerError, "InternalError", "failed to read upload")
+			return
+		}
+		origNames = append(origNames, fh.Filename)
+		uploads = append(uploads, data)
+	}
 
-		safeName := sanitizeFilename(fh.Filename, i)
-		dstPath := filepath.Join(tmpDir, safeName)
-		dst, err := os.Create(dstPath)
-		if err != nil {
-			_ = f.Close()
+	workerReq := workerRequest{Threshold: threshold, Limit: limit}
+	if s.useShm {
+		segments, err := storeShmUploads(uploads, origNames)
+		switch {
+		case err == nil:
+			defer removeShmUploads(segments)
+			workerReq.Shm = segments
+		case errors.Is(err, syscall.ENOSPC):
+			// /dev/shm is small by default in containers; spill to disk instead of failing.
+			slog.Warn("shared memory full, storing upload in temp dir", "files", len(uploads))
+		default:
+			slog.Error("store upload failed", "error", err)
 			s.writeError(w, format, http.StatusInternalServerError, "InternalError", "failed to store upload")
 			return
 		}
+	}
+	if workerReq.Shm == nil {
+		tmpDir, err := os.MkdirTemp("", "autotagger-upload-*")
+		if err != nil {
+			s.writeError(w, format, http.StatusInternalServerError, "InternalError", "failed to create temp dir")
+			return
+		}
+		defer os.RemoveAll(tmpDir)
 
-		_, copyErr := io.Copy(dst, f)
-		_ = dst.Close()
-		_ = f.Close()
-		if copyErr != nil {
-			s.writeError(w, format, http.StatusInternalServerError, "InternalError", "failed to read upload")
+		paths, err := storeDirUploads(tmpDir, uploads, origNames)
+		if err != nil {
+			slog.Error("store upload failed", "error", err)
+			s.writeError(w, format, http.StatusInternalServerError, "InternalError", "failed to store upload")
 			return
 		}
+		workerReq.Files = paths
+	}
 
-		paths = append(paths, dstPath)
-		origNames = append(origNames, fh.Filename)
+	var images [][]byte
+	if format == "html" {
+		images = uploads
 	}
 
 	ctx, cancel := context.WithTimeout(r.Context(), 5*time.Minute)
 	defer cancel()
-	predictions, err := s.workers.predict(ctx, paths, threshold, limit)
+	predictions, err := s.workers.predict(ctx, workerReq)
 	if err != nil {
 		slog.Error("predict failed", "error", err)
 		switch {
@@ -605,11 +651,7 @@ func (s *server) handleEvaluate(w http.ResponseWriter, r *http.Request) {
 			slog.Error("encode json failed", "error", err)
 		}
 	case "html":
-		results, err := buildHTMLResults(paths, predictions)
-		if err != nil {
-			s.writeError(w, format, http.StatusInternalServerError, "InternalError", "failed to render HTML")
-			return
-		}
+		results := buildHTMLResults(images, predictions)
 		if err := s.evalTmpl.Execute(w, results); err != nil {
 			slog.Error("render evaluate failed", "error", err)
 		}
@@ -618,16 +660,12 @@ func (s *server) handleEvaluate(w http.ResponseWriter, r *http.Request) {
 	}
 }
 
-func buildHTMLResults(paths []string, predictions []prediction) ([]htmlResult, error) {
+func buildHTMLResults(images [][]byte, predictions []prediction) []htmlResult {
 	results := make([]htmlResult, 0, len(predictions))
 	for i, pred := range predictions {
-		if i >= len(paths) {
+		if i >= len(images) {
 			break
 		}
-		data, err := os.ReadFile(paths[i])
-		if err != nil {
-			return nil, err
-		}
 		tags := make([]tagPair, 0, len(pred.Tags))
 		tagNames := make([]string, 0, len(pred.Tags))
 		for name, score := range pred.Tags {
@@ -640,12 +678,12 @@ func buildHTMLResults(paths []string, predictions []prediction) ([]htmlResult, e
 		sort.Strings(tagNames)
 
 		results = append(results, htmlResult{
-			ImageData: base64.StdEncoding.EncodeToString(data),
-			Tags:      tags,
-			TagText:   strings.Join(tagNames, " "),
+			image:   images[i],
+			Tags:    tags,
+			TagText: strings.Join(tagNames, " "),
 		})
 	}
-	return results, nil
+	return results
 }
 
 func (s *server) writeError(w http.ResponseWriter, format string, status int, errName, message string) {
@@ -668,6 +706,68 @@ func (s *server) writeError(w http.ResponseWriter, format string, status int, er
 
 const statusClientClosedRequest = 499
 
+// shmDir is where POSIX shared memory objects live on Linux; files created here
+// can be attached by name from Python's multiprocessing.shared_memory.
+const shmDir = "/dev/shm"
+
+func shmAvailable() bool {
+	info, err := os.Stat(shmDir)
+	return err == nil && info.IsDir()
+}
+
+// storeShmUploads writes each upload to its own /dev/shm file. On failure every
+// file created so far is removed, so the caller can fall back to disk.
+func storeShmUploads(uploads [][]byte, names []string) ([]shmSegment, error) {
+	segments := make([]shmSegment, 0, len(uploads))
+	for i, data := range uploads {
+		dst, err := os.CreateTemp(shmDir, "autotagger-*")
+		if err != nil {
+			removeShmUploads(segments)
+			return nil, err
+		}
+		segments = append(segments, shmSegment{Name: filepath.Base(dst.Name()), Size: int64(len(data)), Filename: names[i]})
+		_, err = dst.Write(data)
+		if closeErr := dst.Close(); err == nil {
+			err = closeErr
+		}
+		if err != nil {
+			removeShmUploads(segments)
+			return nil, err
+		}
+	}
+	return segments, nil
+}
+
+func removeShmUploads(segments []shmSegment) {
+	for _, seg := range segments {
+		_ = os.Remove(filepath.Join(shmDir, seg.Name))
+	}
+}
+
+func storeDirUploads(dir string, uploads [][]byte, names []string) ([]string, error) {
+	paths := make([]string, 0, len(uploads))
+	for i, data := range uploads {
+		path := filepath.Join(dir, sanitizeFilename(names[i], i))
+		if err := os.WriteFile(path, data, 0o600); err != nil {
+			return nil, err
+		}
+		paths = append(paths, path)
+	}
+	return paths, nil
+}
+
+func getenvBool(key string, def bool) bool {
+	v := strings.ToLower(strings.TrimSpace(os.Getenv(key)))
+	switch v {
+	case "":
+		return def
+	case "0", "false", "no", "off":
+		return false
+	default:
+		return true
+	}
+}
+
 func parseFloatOrDefault(raw string, def float64) (float64, error) {
 	raw = strings.TrimSpace(raw)
 	if raw == "" {
@@ -780,6 +880,7 @@ func main() {
 	maxFiles := getenvInt("MAX_FILES", 8)
 	maxLimit := getenvInt("MAX_LIMIT", 200)
 	workerProcesses := getenvInt("WORKER_PROCESSES", getenvInt("GPU_PARALLELISM", 2))
+	uploadShm := getenvBool("UPLOAD_SHM", true) && shmAvailable()
 
 	ctx, stop := signal.NotifyContext(context.Background(), os.Interrupt, syscall.SIGTERM)
 	defer stop()
@@ -791,9 +892,12 @@ func main() {
 	}
 	defer workers.close()
 
+	app := newServer(workers, maxInflight, maxUploadMB, maxFileMB, maxFiles, maxLimit)
+	app.useShm = uploadShm
+
 	srv := &http.Server{
 		Addr:              addr,
-		Handler:           newServer(workers, maxInflight, maxUploadMB, maxFileMB, maxFiles, maxLimit).routes(),
+		Handler:           app.routes(),
 		ReadHeaderTimeout: 5 * time.Second,
 		ReadTimeout:       60 * time.Second,
 		WriteTimeout:      6 * time.Minute,
@@ -818,6 +922,7 @@ func main() {
 		"max_files", maxFiles,
 		"max_limit", maxLimit,
 		"worker_processes", workerProcesses,
+		"upload_shm", uploadShm,
 	)
 	if err := srv.ListenAndServe(); err != nil && !errors.Is(err, http.ErrServerClosed) {
 		slog.Error("server failed", "error", err)
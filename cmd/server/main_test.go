@@ -1,10 +1,13 @@
 package main
 
 import (
+	"encoding/json"
 	"mime/multipart"
 	"net/http"
 	"net/http/httptest"
 	"net/textproto"
+	"os"
+	"path/filepath"
 	"testing"
 )
 
@@ -107,3 +110,69 @@ func TestHandleEvaluateRejectsWrongContentType(t *testing.T) {
 		t.Fatalf("status = %d, want %d", rr.Code, http.StatusBadRequest)
 	}
 }
+
+func TestWorkerEnvOverridesWorkerProcesses(t *testing.T) {
+	t.Parallel()
+
+	env := workerEnv([]string{"PATH=/usr/bin", "WORKER_PROCESSES=8"}, 3)
+	want := []string{"PATH=/usr/bin", "WORKER_PROCESSES=3"}
+	if len(env) != len(want) {
+		t.Fatalf("workerEnv() = %v, want %v", env, want)
+	}
+	for i := range want {
+		if env[i] != want[i] {
+			t.Fatalf("workerEnv() = %v, want %v", env, want)
+		}
+	}
+}
+
+func TestWorkerRequestSendsOnlyOneInputKind(t *testing.T) {
+	t.Parallel()
+
+	req := workerRequest{
+		ID:        1,
+		Shm:       []shmSegment{{Name: "autotagger-1", Size: 42, Filename: "a.jpg"}},
+		Threshold: 0.1,
+		Limit:     50,
+	}
+	data, err := json.Marshal(req)
+	if err != nil {
+		t.Fatalf("Marshal() error = %v", err)
+	}
+	want := `{"id":1,"shm":[{"name":"autotagger-1","size":42,"filename":"a.jpg"}],"threshold":0.1,"limit":50}`
+	if string(data) != want {
+		t.Fatalf("Marshal() = %s, want %s", data, want)
+	}
+}
+
+func TestBuildHTMLResults(t *testing.T) {
+	t.Parallel()
+
+	results := buildHTMLResults([][]byte{[]byte("abc")}, []prediction{{Tags: map[string]float64{"b": 0.2, "a": 0.9}}})
+	if len(results) != 1 {
+		t.Fatalf("len(results) = %d, want 1", len(results))
+	}
+	if results[0].Tags[0].Name != "a" || results[0].TagText != "a b" {
+		t.Fatalf("results[0] = %+v, want tags sorted by score and names sorted", results[0])
+	}
+	if data := results[0].ImageData(); data != "YWJj" {
+		t.Fatalf("ImageData() = %q, want %q", data, "YWJj")
+	}
+}
+
+func TestStoreDirUploads(t *testing.T) {
+	dir := t.TempDir()
+	paths, err := storeDirUploads(dir, [][]byte{[]byte("a"), []byte("bc")}, []string{"../x.jpg", ""})
+	if err != nil {
+		t.Fatalf("storeDirUploads: %v", err)
+	}
+	want := []string{filepath.Join(dir, "x.jpg"), filepath.Join(dir, "upload-1")}
+	for i, path := range paths {
+		if path != want[i] {
+			t.Fatalf("path %d = %q, want %q", i, path, want[i])
+		}
+		if _, err := os.Stat(path); err != nil {
+			t.Fatalf("stat %q: %v", path, err)
+		}
+	}
+}
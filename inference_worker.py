@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 
+import itertools
 import json
 import logging
 import os
+import queue
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
 
 from autotagger import Autotagger
@@ -11,20 +18,184 @@ from autotagger import Autotagger
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
+_stdout_lock = threading.Lock()
+
 
 def build_tagger() -> Autotagger:
     model_path = os.getenv("MODEL_PATH", "models/model.pth")
     return Autotagger(model_path)
 
 
-def predict_files(tagger: Autotagger, files: list[str], threshold: float, limit: int):
-    names = [Path(path).name for path in files]
+def get_env_float(name: str, default: float, minimum: float | None = None) -> float:
+    raw = os.getenv(name, str(default)).strip()
+    try:
+        value = float(raw)
+    except ValueError:
+        logging.warning("Invalid number for %s: %r; using default %s", name, raw, default)
+        value = default
+    if minimum is not None:
+        value = max(minimum, value)
+    return value
+
+
+def predict_files(tagger: Autotagger, files: list, threshold: float, limit: int, names: list[str] | None = None):
+    if names is None:
+        names = [Path(path).name for path in files]
     predictions = tagger.predict(files, threshold=threshold, limit=limit)
     return [{"filename": name, "tags": tags} for name, tags in zip(names, predictions)]
 
 
+def attach_shared_memory(segments: list[dict]):
+    # The parent owns the segments and unlinks them; the worker only maps them.
+    handles = []
+    try:
+        for segment in segments:
+            handles.append(SharedMemory(name=segment["name"], track=False))
+    except Exception:
+        for handle in handles:
+            handle.close()
+        raise
+    views = [handle.buf[: int(segment["size"])] for handle, segment in zip(handles, segments)]
+    names = [segment.get("filename") or segment["name"] for segment in segments]
+    return handles, views, names
+
+
+def release_shared_memory(handles, views, _future=None):
+    try:
+        for view in views:
+            view.release()
+        for handle in handles:
+            handle.close()
+    except BufferError as e:
+        logging.warning("Shared memory still referenced after request: %s", e)
+
+
+def filter_tags(tags: dict, threshold: float, limit: int) -> dict:
+    # Tags arrive sorted by descending score, so the first miss ends the scan.
+    kept = itertools.takewhile(lambda pair: pair[1] >= threshold, tags.items())
+    return dict(itertools.islice(kept, limit))
+
+
+class RequestBatcher:
+    # Requests that arrive within `max_wait` of each other share one predict call
+    # run with the loosest threshold/limit; each slice is then narrowed back down.
+    def __init__(self, tagger: Autotagger, max_batch: int, max_wait: float, workers: int = 1):
+        self.tagger = tagger
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        # One collector forms batches; each goes to the next free lane. Waiting for a
+        # free lane before collecting lets requests pile up into a bigger batch meanwhile.
+        self.slots = threading.Semaphore(workers)
+        # With a single lane the collector predicts itself rather than paying a thread hop.
+        self.executor = None
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="request-batcher")
+        self.thread = threading.Thread(target=self._run, name="request-collector", daemon=True)
+        self.thread.start()
+
+    def submit(self, files: list, names: list[str] | None, threshold: float, limit: int) -> Future:
+        future = Future()
+        if names is None:
+            names = [Path(path).name for path in files]
+        self.queue.put((files, names, threshold, limit, future))
+        return future
+
+    def _collect(self):
+        items = [self.queue.get()]
+        count = len(items[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            items.append(item)
+            count += len(item[0])
+        return items
+
+    def _run(self):
+        while True:
+            self.slots.acquire()
+            items = self._collect()
+            if self.executor is None:
+                self._process(items)
+            else:
+                self.executor.submit(self._process, items)
+
+    def _process(self, items):
+        try:
+            if len(items) == 1:
+                self._predict_one(items[0])
+            else:
+                self._predict_many(items)
+        finally:
+            self.slots.release()
+            for _ in items:
+                self.queue.task_done()
+
+    def join(self):
+        self.queue.join()
+
+    def _predict_one(self, item):
+        files, names, threshold, limit, future = item
+        try:
+            future.set_result(predict_files(self.tagger, files, threshold, limit, names))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _predict_many(self, items):
+        files = [path for item in items for path in item[0]]
+        names = [name for item in items for name in item[1]]
+        threshold = min(item[2] for item in items)
+        limit = max(item[3] for item in items)
+        try:
+            predictions = predict_files(self.tagger, files, threshold, limit, names)
+        except Exception:
+            # Retry individually so one bad upload does not fail its neighbours.
+            for item in items:
+                self._predict_one(item)
+            return
+
+        offset = 0
+        for item_files, _, item_threshold, item_limit, future in items:
+            chunk = predictions[offset : offset + len(item_files)]
+            offset += len(item_files)
+            future.set_result([
+                {"filename": pred["filename"], "tags": filter_tags(pred["tags"], item_threshold, item_limit)}
+                for pred in chunk
+            ])
+
+
+def write_response(res: dict):
+    with _stdout_lock:
+        sys.stdout.write(json.dumps(res, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+
+def respond(req_id, future: Future):
+    try:
+        res = {"id": req_id, "predictions": future.result()}
+    except Exception as e:
+        res = {"id": req_id, "error": f"{type(e).__name__}: {e}"}
+    write_response(res)
+
+
 def main() -> int:
     tagger = build_tagger()
+    batch_wait_ms = get_env_float("BATCH_WAIT_MS", 8.0, minimum=0.0)
+    # With one lane and no batching window the queue adds nothing but a thread hop.
+    batcher = None
+    if batch_wait_ms > 0 or tagger.stream_count > 1:
+        batcher = RequestBatcher(
+            tagger,
+            max_batch=tagger.batch_size,
+            max_wait=batch_wait_ms / 1000.0,
+            workers=tagger.stream_count,
+        )
 
     for line in sys.stdin:
         line = line.strip()
@@ -36,17 +207,34 @@ def main() -> int:
             req = json.loads(line)
             req_id = req.get("id")
             files = req.get("files", [])
+            names = None
             threshold = float(req.get("threshold", 0.1))
             limit = int(req.get("limit", 50))
-
-            predictions = predict_files(tagger, files, threshold, limit)
-            res = {"id": req_id, "predictions": predictions}
+            handles = views = []
+            if req.get("shm"):
+                handles, views, names = attach_shared_memory(req["shm"])
+                files = views
         except Exception as e:
-            res = {"id": req_id, "error": f"{type(e).__name__}: {e}"}
+            write_response({"id": req_id, "error": f"{type(e).__name__}: {e}"})
+            continue
 
-        sys.stdout.write(json.dumps(res, ensure_ascii=False) + "\n")
-        sys.stdout.flush()
+        if batcher is None:
+            try:
+                res = {"id": req_id, "predictions": predict_files(tagger, files, threshold, limit, names)}
+            except Exception as e:
+                res = {"id": req_id, "error": f"{type(e).__name__}: {e}"}
+            finally:
+                release_shared_memory(handles, views)
+            write_response(res)
+            continue
+
+        future = batcher.submit(files, names, threshold, limit)
+        future.add_done_callback(partial(respond, req_id))
+        if handles:
+            future.add_done_callback(partial(release_shared_memory, handles, views))
 
+    if batcher is not None:
+        batcher.join()
     return 0
 
 